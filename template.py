@@ -16,6 +16,10 @@ except NameError:
     import nltk
 import itertools
 chain = itertools.chain.from_iterable
+from collections import OrderedDict
+from array import array
+import numpy as np
+from multiprocessing import Pool, RawArray
 
 from nltk.corpus import brown
 from nltk.tag import map_tag, tagset_mapping
@@ -31,6 +35,502 @@ if map_tag('brown', 'universal', 'NR-TL') != 'NOUN':
     tm=tagset_mapping('en-brown','universal')
     tm['NR-TL']=tm['NR-TL-HL']='NOUN'
 
+# Part C: semi-supervised (Baum-Welch) training on untagged sentences.
+# The E-step runs in worker processes, so its helpers live at module level
+#  where multiprocessing can pickle them.
+
+def _log2_sum(x, axis):
+    """
+    Numerically stable log base 2 of a sum of base 2 exponentials
+    :param x: log base 2 values
+    :type x: numpy.ndarray
+    :param axis: the axis to sum over
+    :type axis: int
+    :return: log2(sum(2**x)) along axis
+    :rtype: numpy.ndarray
+    """
+    m = np.max(x, axis=axis, keepdims=True)
+    return np.squeeze(m, axis) + np.log2(np.sum(np.exp2(x - m), axis=axis))
+
+def _lidstone_log2(counts, gamma=0.01):
+    """
+    Row-wise log base 2 Lidstone estimates, with the same gamma and extra bin
+    as the LidstoneProbDist factories in emission_model and transition_model
+    :param counts: (expected) counts, one row per condition
+    :type counts: numpy.ndarray
+    :param gamma: the Lidstone gamma
+    :type gamma: float
+    :return: log base 2 probabilities, same shape as counts
+    :rtype: numpy.ndarray
+    """
+    bins = np.count_nonzero(counts, axis=1) + 1
+    return np.log2(counts + gamma) - np.log2(counts.sum(axis=1) + bins * gamma)[:, None]
+
+class _ExpectedCounts:
+    """
+    Partial expected counts from the E-step, mergeable across workers.
+    Emission counts are either dense over the whole vocabulary (words is None)
+    or restricted to the word ids listed in words.
+    """
+    def __init__(self, n_states, n_words, words=None):
+        self.start = np.zeros(n_states)
+        self.trans = np.zeros((n_states, n_states))
+        self.end = np.zeros(n_states)
+        self.words = words
+        self.emit = np.zeros((n_words if words is None else len(words), n_states))
+        self.loglik = 0.0
+
+    def merge(self, other):
+        """
+        Add another partial into this (dense) one
+        :param other: the partial counts to add
+        :type other: _ExpectedCounts
+        """
+        self.start += other.start
+        self.trans += other.trans
+        self.end += other.end
+        if other.words is None:
+            self.emit += other.emit
+        else:
+            # ids in other.words are unique, so fancy-index += is safe
+            self.emit[other.words] += other.emit
+        self.loglik += other.loglik
+
+# Tables and word ids for the E-step, attached once per worker process
+#  by the pool initializer. Both live in shared memory, so workers don't
+#  hold copies of the corpus and each iteration only rewrites the tables.
+_baum_welch_tables = None
+_baum_welch_ids = None
+_baum_welch_layouts = None
+
+def _shared_tables(shapes):
+    """
+    Shared memory arrays for the E-step tables
+    :param shapes: the shape of each table
+    :type shapes: list(tuple(int))
+    :return: The raw shared buffers and numpy views onto them
+    :rtype: tuple(list(multiprocessing.RawArray),tuple(numpy.ndarray))
+    """
+    buffers = [RawArray('d', int(np.prod(shape))) for shape in shapes]
+    return buffers, tuple(np.frombuffer(buffer).reshape(shape) for (buffer, shape) in zip(buffers, shapes))
+
+def _chunk_batches(ids, layout):
+    """
+    The word id batches of one chunk, as views into the shared word ids
+    :param ids: all the word ids
+    :type ids: numpy.ndarray
+    :param layout: (offset, sentences, length) of each batch in the chunk
+    :type layout: list(tuple(int,int,int))
+    :return: word id arrays, each (sentences, length)
+    :rtype: list(numpy.ndarray)
+    """
+    return [ids[offset:offset + n * length].reshape(n, length) for (offset, n, length) in layout]
+
+def _baum_welch_init(buffers, shapes, ids_buffer, layouts):
+    """
+    Pool initializer: attach to the shared tables and word ids
+    :param buffers: the shared (start, trans, end, emit) tables
+    :type buffers: list(multiprocessing.RawArray)
+    :param shapes: the shape of each table
+    :type shapes: list(tuple(int))
+    :param ids_buffer: the shared word ids of all the sentences
+    :type ids_buffer: multiprocessing.RawArray
+    :param layouts: the batches of each chunk, see _chunk_batches
+    :type layouts: list(list(tuple(int,int,int)))
+    """
+    global _baum_welch_tables, _baum_welch_ids, _baum_welch_layouts
+    _baum_welch_tables = tuple(np.frombuffer(buffer).reshape(shape) for (buffer, shape) in zip(buffers, shapes))
+    _baum_welch_ids = np.frombuffer(ids_buffer, dtype=np.int32)
+    _baum_welch_layouts = layouts
+
+def _baum_welch_expect_chunk(i):
+    """
+    E-step over one chunk of the shared word ids, with the shared tables
+    :param i: the chunk number
+    :type i: int
+    :return: the expected counts and log likelihood of the chunk
+    :rtype: _ExpectedCounts
+    """
+    return _baum_welch_expect(_chunk_batches(_baum_welch_ids, _baum_welch_layouts[i]), _baum_welch_tables)
+
+def _baum_welch_expect(batches, tables):
+    """
+    E-step: forward-backward in log base 2 space over a chunk of sentences
+    :param batches: word id arrays, each (sentences, length) for sentences of one length
+    :type batches: list(numpy.ndarray)
+    :param tables: (start, trans, end, emit) log base 2 tables
+    :type tables: tuple(numpy.ndarray)
+    :return: the expected counts and log likelihood of the chunk
+    :rtype: _ExpectedCounts
+    """
+    start, trans, end, emit = tables
+    n_states = len(start)
+    words = np.unique(np.concatenate([ids.ravel() for ids in batches]))
+    counts = _ExpectedCounts(n_states, 0, words)
+
+    # Every step is vectorised over all the sentences of a batch and all states
+    for ids in batches:
+        length = ids.shape[1]
+        em = emit[ids]   # (sentences, length, states)
+        alpha = np.empty_like(em)
+        beta = np.empty_like(em)
+        alpha[:, 0] = start + em[:, 0]
+        for t in range(1, length):
+            alpha[:, t] = _log2_sum(alpha[:, t-1, :, None] + trans, 1) + em[:, t]
+        beta[:, -1] = end
+        for t in range(length - 2, -1, -1):
+            beta[:, t] = _log2_sum(trans + (em[:, t+1] + beta[:, t+1])[:, None, :], 2)
+        # log P(sentence), one per sentence
+        loglik = _log2_sum(alpha[:, -1] + end, 1)
+
+        # State posteriors and pairwise (transition) posteriors
+        gamma = np.exp2(alpha + beta - loglik[:, None, None])
+        counts.start += gamma[:, 0].sum(0)
+        counts.end += gamma[:, -1].sum(0)
+        for t in range(length - 1):
+            counts.trans += np.exp2(alpha[:, t, :, None] + trans
+                                    + (em[:, t+1] + beta[:, t+1])[:, None, :]
+                                    - loglik[:, None, None]).sum(0)
+        np.add.at(counts.emit, np.searchsorted(words, ids.ravel()), gamma.reshape(-1, n_states))
+        counts.loglik += loglik.sum()
+
+    return counts
+
+# Part D: compact decode tables.
+# Costs (-log base 2 probabilities) in numpy arrays instead of the tree of
+#  ConditionalProbDists, so the decoder does array lookups rather than
+#  recomputing logs from count dicts.
+
+class QuantizedTables:
+    """
+    Transition and emission costs of a trained HMM, stored as float32,
+    or as int16 fixed-point costs sharing one scale.
+    The vocabulary is a dict, or when compact, one sorted UTF-8 buffer plus
+    offsets searched by bisection: slower to look up but a fraction of the size.
+    Words outside the vocabulary use the per-state unseen cost.
+    """
+    def __init__(self, states, vocab, start, trans, end, emit, unseen, dtype='int16', compact=False):
+        """
+        Quantize the given costs.
+        :param states: The state names, in table column order
+        :type states: list(str)
+        :param vocab: The sorted words, in emit row order
+        :type vocab: list(str)
+        :param start: Costs of <s> to each state
+        :type start: numpy.ndarray
+        :param trans: Costs from each state (rows) to each state (columns)
+        :type trans: numpy.ndarray
+        :param end: Costs of each state to </s>
+        :type end: numpy.ndarray
+        :param emit: Costs of each word (rows) from each state (columns)
+        :type emit: numpy.ndarray
+        :param unseen: Costs of an unseen word from each state
+        :type unseen: numpy.ndarray
+        :param dtype: 'float32' or 'int16'
+        :type dtype: str
+        :param compact: Store the vocabulary as a buffer rather than a dict
+        :type compact: bool
+        """
+        if dtype == 'float32':
+            self.scale = 1.0
+            self.accumulator = np.float32
+        elif dtype == 'int16':
+            # One scale for all tables, so costs from different tables add up
+            top = max(t.max() for t in (start, trans, end, emit, unseen) if t.size)
+            self.scale = float(np.iinfo(np.int16).max / top)
+            self.accumulator = np.int64
+        else:
+            raise ValueError('dtype must be float32 or int16, not %s' % dtype)
+        self.dtype = dtype
+        self.states = list(states)
+        self.compact = compact
+        if compact:
+            # UTF-8 byte order is code point order, so the sorted words stay sorted
+            encoded = [word.encode('utf-8') for word in vocab]
+            self.words = b''.join(encoded)
+            # An array rather than numpy, so indexing gives cheap Python ints
+            self.offsets = array('I', itertools.accumulate((len(word) for word in encoded), initial=0))
+            self.index = None
+        else:
+            self.index = {word: i for (i, word) in enumerate(vocab)}
+        self.start, self.trans, self.end, self.emit, self.unseen = \
+            [self.quantize(t) for t in (start, trans, end, emit, unseen)]
+
+    def quantize(self, costs):
+        """
+        :param costs: costs in bits
+        :type costs: numpy.ndarray
+        :return: the costs in table units
+        :rtype: numpy.ndarray
+        """
+        if self.dtype == 'float32':
+            return np.ascontiguousarray(costs, dtype=np.float32)
+        return np.rint(costs * self.scale).astype(np.int16)
+
+    def dequantize(self, value):
+        """
+        :param value: a cost in table units
+        :return: the cost in bits
+        :rtype: float
+        """
+        return float(value) / self.scale
+
+    def emission(self, word):
+        """
+        :param word: the word
+        :type word: str
+        :return: The costs of emitting word from each state, in table units
+        :rtype: numpy.ndarray
+        """
+        row = self.index.get(word) if self.index is not None else self.lookup(word)
+        return self.unseen if row is None else self.emit[row]
+
+    def lookup(self, word):
+        """
+        :param word: the word
+        :type word: str
+        :return: The row of word in emit, None if it is not in the vocabulary
+        :rtype: int
+        """
+        if self.index is not None:
+            return self.index.get(word)
+        key = word.encode('utf-8')
+        words, offsets = self.words, self.offsets
+        lo, hi = 0, len(offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if words[offsets[mid]:offsets[mid+1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(offsets) - 1 and words[offsets[lo]:offsets[lo+1]] == key:
+            return lo
+        return None
+
+    @property
+    def nbytes(self):
+        """
+        Size of the cost arrays and the vocabulary in bytes
+        :rtype: int
+        """
+        if self.index is not None:
+            vocab = sys.getsizeof(self.index) + sum(sys.getsizeof(word) for word in self.index)
+        else:
+            vocab = len(self.words) + self.offsets.itemsize * len(self.offsets)
+        return vocab + sum(t.nbytes for t in (self.start, self.trans, self.end, self.emit, self.unseen))
+
+# Part E: decode cache.
+# Whole sentences are cached in an LRU, and the Viterbi columns of every
+#  decoded prefix are kept in a trie so a new sentence can resume from the
+#  deepest prefix it shares with an earlier one.
+
+class _LatticeNode:
+    """
+    A trie node holding the viterbi and backpointer columns for one word
+    """
+    __slots__ = ('token', 'parent', 'children', 'viterbi', 'backpointer', 'nbytes')
+
+    # Rough per-node overhead on top of the columns and token, in bytes:
+    #  the node, its children dict, and its entries in the parent and LRU
+    OVERHEAD = 320
+
+    def __init__(self, token, parent, viterbi, backpointer):
+        self.token = token
+        self.parent = parent
+        self.children = {}
+        # Columns are kept as contiguous arrays, whose size is known exactly
+        self.viterbi = None if viterbi is None else np.asarray(viterbi, dtype=getattr(viterbi, 'dtype', float))
+        self.backpointer = None if backpointer is None else np.asarray(backpointer, dtype=np.int16)
+        self.nbytes = self.OVERHEAD + sys.getsizeof(token) + \
+            sys.getsizeof(self.viterbi) + sys.getsizeof(self.backpointer)
+
+class DecodeCache:
+    """
+    Bounded cache of decoded sentences and of their Viterbi lattice prefixes.
+    Memory use is an estimate, kept under max_bytes by evicting the least
+    recently used sentences and trie leaves.
+    The cache follows one model at a time, and empties itself when the
+    model is retrained or its quantized tables change.
+    """
+
+    # Rough per-sentence overhead on top of the key and tags, in bytes
+    OVERHEAD = 200
+
+    def __init__(self, max_sentences=10000, max_bytes=64 * 2**20):
+        """
+        Create an empty cache.
+        :param max_sentences: The most whole sentences to keep
+        :type max_sentences: int
+        :param max_bytes: The (approximate) memory cap for sentences and lattice columns
+        :type max_bytes: int
+        """
+        self.max_sentences = max_sentences
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.tokens = 0
+        self.cached_tokens = 0
+        self.clear()
+
+    def clear(self):
+        """
+        Drop every cached sentence and lattice column, e.g. after retraining
+        """
+        # token tuple -> (tags, size in bytes), least recently used first
+        self.sentences = OrderedDict()
+        # trie nodes, least recently used first; touching a path leaf to root
+        #  keeps every node older than its ancestors, so the oldest is a leaf
+        self.nodes = OrderedDict()
+        self.root = _LatticeNode(None, None, None, None)
+        self.sentence_bytes = 0
+        self.node_bytes = 0
+        # What the cached results were decoded with
+        self.model = None
+        self.generation = None
+        self.tables = None
+
+    @property
+    def nbytes(self):
+        """
+        :return: Estimated memory held by the cache, in bytes
+        :rtype: int
+        """
+        return self.sentence_bytes + self.node_bytes
+
+    def stats(self):
+        """
+        :return: Hit, miss and eviction counts, tokens decoded and served from
+          the cache, and the current size
+        :rtype: dict(str,int)
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'tokens': self.tokens, 'cached_tokens': self.cached_tokens,
+                'sentences': len(self.sentences), 'nodes': len(self.nodes),
+                'bytes': self.nbytes}
+
+    def tag(self, model, words):
+        """
+        Tag a sentence with the model, reusing cached results where possible
+        :param model: The trained model
+        :type model: HMM
+        :param words: The normalised (lowercased) sentence
+        :type words: tuple(str)
+        :return: List of tags corresponding to each word of the input
+        :rtype: list(str)
+        """
+        # Results from another model, an earlier training, or different
+        #  tables are stale
+        if model is not self.model or model.generation != self.generation or model.tables is not self.tables:
+            self.clear()
+            self.model = model
+            self.generation = model.generation
+            self.tables = model.tables
+        self.tokens += len(words)
+
+        # Deepest cached prefix
+        node = self.root
+        depth = 0
+        while depth < len(words) and words[depth] in node.children:
+            node = node.children[words[depth]]
+            depth += 1
+
+        if words in self.sentences:
+            self.hits += 1
+            self.cached_tokens += len(words)
+            self.sentences.move_to_end(words)
+            # Leave the model's lattice for this sentence, if its columns are still cached
+            if depth == len(words):
+                self.load_lattice(model, node)
+            else:
+                model.viterbi.clear()
+                model.backpointer.clear()
+            return list(self.sentences[words][0])
+        self.misses += 1
+        self.cached_tokens += depth
+
+        # Resume Viterbi from its columns, or start afresh
+        if depth == 0:
+            model.initialise(words[0])
+            depth = 1
+            node = None
+        else:
+            self.load_lattice(model, node)
+        tags = model.tag(list(words[depth:]))
+
+        # Add the new columns to the trie, then mark the path used leaf to root
+        if node is None:
+            node = self.add_node(self.root, words[0], model.viterbi[0], model.backpointer[0])
+        for (token, viterbi, backpointer) in zip(words[depth:], model.viterbi[depth:], model.backpointer[depth:]):
+            node = self.add_node(node, token, viterbi, backpointer)
+        while node is not self.root:
+            self.nodes.move_to_end(node)
+            node = node.parent
+
+        tags = tuple(tags)
+        size = self.OVERHEAD + sys.getsizeof(words) + sum(sys.getsizeof(word) for word in words) + \
+            sys.getsizeof(tags)
+        self.sentences[words] = (tags, size)
+        self.sentence_bytes += size
+        self.evict()
+
+        return list(tags)
+
+    def load_lattice(self, model, node):
+        """
+        Set the model's viterbi and backpointer to the columns from the root to node,
+        and mark them used
+        :param model: The model being decoded with
+        :type model: HMM
+        :param node: The last node of the path
+        :type node: _LatticeNode
+        """
+        path = []
+        while node is not self.root:
+            self.nodes.move_to_end(node)
+            path.append(node)
+            node = node.parent
+        path.reverse()
+        if model.tables is None:
+            # The PD decoder works on lists of Python floats
+            model.viterbi[:] = [step.viterbi.tolist() for step in path]
+            model.backpointer[:] = [step.backpointer.tolist() for step in path]
+        else:
+            model.viterbi[:] = [step.viterbi for step in path]
+            model.backpointer[:] = [step.backpointer for step in path]
+
+    def add_node(self, parent, token, viterbi, backpointer):
+        """
+        :return: A new trie node under parent
+        :rtype: _LatticeNode
+        """
+        node = _LatticeNode(token, parent, viterbi, backpointer)
+        parent.children[token] = node
+        self.nodes[node] = None
+        self.node_bytes += node.nbytes
+        return node
+
+    def evict(self):
+        """
+        Evict least recently used entries until within both limits
+        """
+        while len(self.sentences) > self.max_sentences:
+            self.evict_sentence()
+        while self.nbytes > self.max_bytes and (self.sentences or self.nodes):
+            # Take from whichever store is holding more memory
+            if self.nodes and self.node_bytes >= self.sentence_bytes:
+                (node, _) = self.nodes.popitem(last=False)
+                del node.parent.children[node.token]
+                self.node_bytes -= node.nbytes
+                self.evictions += 1
+            else:
+                self.evict_sentence()
+
+    def evict_sentence(self):
+        (words, (tags, size)) = self.sentences.popitem(last=False)
+        self.sentence_bytes -= size
+        self.evictions += 1
+
 class HMM:
     def __init__(self, train_data, test_data):
         """
@@ -51,6 +551,14 @@ class HMM:
         self.viterbi = []
         self.backpointer = []
 
+        # Quantized decode tables, used by initialise and tag when set
+        self.tables = None
+
+        # Optional DecodeCache, used by tag_sentence when set
+        self.cache = None
+        # Bumped whenever emission_PD or transition_PD change, so caches can tell
+        self.generation = 0
+
     # Compute emission model using ConditionalProbDist with a LidstoneProbDist estimator.
     #   To achieve the latter, pass a function
     #    as the probdist_factory argument to ConditionalProbDist.
@@ -81,6 +589,7 @@ class HMM:
 
         emission_FD = ConditionalFreqDist(data)
         self.emission_PD = ConditionalProbDist(emission_FD, lambda f:nltk.probability.LidstoneProbDist(f,0.01,f.B()+1))
+        self.generation += 1
         self.states = list(set([tag for (tag,word) in data]))
 
         return self.emission_PD, self.states
@@ -124,6 +633,7 @@ class HMM:
 
         transition_FD = ConditionalFreqDist(data)
         self.transition_PD = ConditionalProbDist(transition_FD, lambda f:nltk.probability.LidstoneProbDist(f,0.01,f.B()+1))
+        self.generation += 1
 
         return self.transition_PD
 
@@ -149,6 +659,266 @@ class HMM:
         """
         self.emission_model(self.train_data)
         self.transition_model(self.train_data)
+        self.tables = None
+
+    # Counts behind emission_PD and transition_PD as dense arrays
+    def count_arrays(self, index, data=None):
+        """
+        The emission and transition counts of the trained model as arrays.
+        Transition rows are <s> followed by the states,
+        columns are the states followed by </s>
+        :param index: Row number of each word in the emission counts
+        :type index: dict(str,int)
+        :param data: Count these tagged sentences instead of reading the trained model
+        :type data: list(list(tuple(str,str)))
+        :return: The (words, states) emission counts and (states+1, states+1) transition counts
+        :rtype: tuple(numpy.ndarray,numpy.ndarray)
+        """
+        states = self.states
+        emit = np.zeros((len(index), len(states)))
+        if data is not None:
+            # The same counts emission_model and transition_model make
+            trans = np.zeros((len(states) + 1, len(states) + 1))
+            column = {state: i for (i, state) in enumerate(states)}
+            for sentence in data:
+                last = 0
+                for (word, tag) in sentence:
+                    emit[index[word.lower()], column[tag]] += 1
+                    trans[last, column[tag]] += 1
+                    last = column[tag] + 1
+                trans[last, -1] += 1
+            return emit, trans
+        for (i, state) in enumerate(states):
+            for (word, count) in self.emission_PD[state].freqdist().items():
+                emit[index[word], i] = count
+        trans = np.zeros((len(states) + 1, len(states) + 1))
+        for (i, state1) in enumerate(['<s>'] + states):
+            for (j, state2) in enumerate(states + ['</s>']):
+                trans[i, j] = self.transition_PD[state1].freqdist()[state2]
+        return emit, trans
+
+    # Semi-supervised training with Baum-Welch (EM).
+    # Starts from the supervised emission_PD and transition_PD, and
+    #  re-estimates them from the supervised counts plus the expected counts
+    #  over the untagged sentences, until the log likelihood settles.
+    def baum_welch(self, unlabeled_data, max_iterations=10, tolerance=1e-4,
+                   min_count=0.01, processes=None, batch_size=256, chunk_size=8192):
+        """
+        Refine the trained model with EM over untagged sentences
+        :param unlabeled_data: The untagged dataset, a list of sentences
+        :type unlabeled_data: list(list(str))
+        :param max_iterations: The maximum number of EM iterations
+        :type max_iterations: int
+        :param tolerance: Stop once the log likelihood (base 2) per untagged word changes by less than this
+        :type tolerance: float
+        :param min_count: Expected emission counts below this are dropped, so words
+          don't get an entry (and a Lidstone bin) in every state
+        :type min_count: float
+        :param processes: Number of worker processes for the E-step, None for all CPUs, 1 to run in-process
+        :type processes: int
+        :param batch_size: Maximum number of same-length sentences handled together
+        :type batch_size: int
+        :param chunk_size: Roughly how many sentences are sent to a worker at a time
+        :type chunk_size: int
+        :return: The total log likelihood (base 2) of the untagged data at each iteration
+        :rtype: list(float)
+        """
+        if self.emission_PD is None or self.transition_PD is None:
+            self.train()
+        states = self.states
+        n_states = len(states)
+
+        # Vocabulary: the supervised words followed by any new untagged ones
+        vocab = sorted(set(word.lower() for sentence in self.train_data for (word, tag) in sentence))
+        index = {word: i for (i, word) in enumerate(vocab)}
+        sentences = []
+        for sentence in unlabeled_data:
+            if len(sentence) == 0:
+                continue
+            ids = []
+            for word in sentence:
+                word = word.lower()
+                if word not in index:
+                    index[word] = len(vocab)
+                    vocab.append(word)
+                ids.append(index[word])
+            sentences.append(ids)
+
+        # Supervised counts, kept fixed across iterations. They come from the
+        #  training data, as the model may already hold expected counts from
+        #  an earlier run
+        sup_emit, sup_trans = self.count_arrays(index, self.train_data)
+
+        # Group sentences of equal length into batches, so the E-step can
+        #  vectorise across sentences, and batches into chunks for the workers.
+        # All word ids sit in one shared memory array; a chunk is a list of
+        #  (offset, sentences, length) batches within it
+        sentences.sort(key=len)
+        n_tokens = sum(len(ids) for ids in sentences)
+        ids_buffer = RawArray('i', n_tokens)
+        all_ids = np.frombuffer(ids_buffer, dtype=np.int32)
+        layouts = []
+        in_chunk = 0
+        offset = 0
+        for (length, group) in itertools.groupby(sentences, key=len):
+            group = list(group)
+            for i in range(0, len(group), batch_size):
+                batch = group[i:i+batch_size]
+                all_ids[offset:offset + len(batch) * length] = list(chain(batch))
+                if len(layouts) == 0 or in_chunk >= chunk_size:
+                    layouts.append([])
+                    in_chunk = 0
+                layouts[-1].append((offset, len(batch), length))
+                in_chunk += len(batch)
+                offset += len(batch) * length
+        del sentences
+
+        # One pool for the whole run. Workers attach to the shared word ids
+        #  and tables once, and each iteration just rewrites the tables
+        shapes = [(n_states,), (n_states, n_states), (n_states,), (len(vocab), n_states)]
+        buffers, tables = _shared_tables(shapes)
+        pool = None
+        if processes != 1 and len(layouts) > 0:
+            pool = Pool(processes, initializer=_baum_welch_init, initargs=(buffers, shapes, ids_buffer, layouts))
+
+        emit_counts, trans_counts = sup_emit, sup_trans
+        history = []
+        try:
+            for iteration in range(max_iterations):
+                trans_table = _lidstone_log2(trans_counts)
+                tables[0][:] = trans_table[0, :-1]
+                tables[1][:] = trans_table[1:, :-1]
+                tables[2][:] = trans_table[1:, -1]
+                tables[3][:] = _lidstone_log2(emit_counts.T).T
+
+                # E-step
+                expected = _ExpectedCounts(n_states, len(vocab))
+                if pool is None:
+                    for layout in layouts:
+                        expected.merge(_baum_welch_expect(_chunk_batches(all_ids, layout), tables))
+                else:
+                    for partial in pool.imap_unordered(_baum_welch_expect_chunk, range(len(layouts))):
+                        expected.merge(partial)
+
+                # M-step
+                expected.emit[expected.emit < min_count] = 0.0
+                emit_counts = sup_emit + expected.emit
+                trans_counts = sup_trans.copy()
+                trans_counts[0, :-1] += expected.start
+                trans_counts[1:, :-1] += expected.trans
+                trans_counts[1:, -1] += expected.end
+
+                history.append(float(expected.loglik))
+                if len(history) > 1 and abs(history[-1] - history[-2]) / max(n_tokens, 1) < tolerance:
+                    break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # Rebuild the models so elprob, tlprob and tagging use the new estimates
+        emission_FD = ConditionalFreqDist()
+        for (i, state) in enumerate(states):
+            for j in np.flatnonzero(emit_counts[:, i]):
+                emission_FD[state][vocab[j]] = float(emit_counts[j, i])
+        self.emission_PD = ConditionalProbDist(emission_FD, lambda f:nltk.probability.LidstoneProbDist(f,0.01,f.B()+1))
+        self.generation += 1
+
+        transition_FD = ConditionalFreqDist()
+        for (i, state1) in enumerate(['<s>'] + states):
+            for (j, state2) in enumerate(states + ['</s>']):
+                if trans_counts[i, j] > 0:
+                    transition_FD[state1][state2] = float(trans_counts[i, j])
+        self.transition_PD = ConditionalProbDist(transition_FD, lambda f:nltk.probability.LidstoneProbDist(f,0.01,f.B()+1))
+        self.generation += 1
+        self.tables = None
+
+        return history
+
+    # Export the trained model as quantized decode tables
+    def export_tables(self, dtype='int16', compact=False):
+        """
+        Build compact cost tables from emission_PD and transition_PD
+        :param dtype: 'float32', or 'int16' for fixed-point costs with a shared scale
+        :type dtype: str
+        :param compact: Store the vocabulary as a buffer rather than a dict
+        :type compact: bool
+        :return: The decode tables
+        :rtype: QuantizedTables
+        """
+        vocab = sorted(set(chain(self.emission_PD[state].samples() for state in self.states)))
+        emit_counts, trans_counts = self.count_arrays({word: i for (i, word) in enumerate(vocab)})
+        # An extra all-zero row gives each state's smoothed unseen word cost
+        emit = -_lidstone_log2(np.vstack([emit_counts, np.zeros(len(self.states))]).T).T
+        trans = -_lidstone_log2(trans_counts)
+        return QuantizedTables(self.states, vocab, trans[0, :-1], trans[1:, :-1],
+                               trans[1:, -1], emit[:-1], emit[-1], dtype, compact)
+
+    # Switch decoding to quantized tables.
+    # Once quantized, initialise and tag decode from the tables; set
+    #  self.tables to None to go back to emission_PD and transition_PD,
+    #  unless they were released, in which case the model must be retrained.
+    def quantize(self, dtype='int16', release=False):
+        """
+        Export the trained model as compact cost tables, and decode with them
+        :param dtype: 'float32', or 'int16' for fixed-point costs with a shared scale
+        :type dtype: str
+        :param release: Drop emission_PD and transition_PD, leaving only the tables
+          resident, with the compact vocabulary
+        :type release: bool
+        :return: The decode tables
+        :rtype: QuantizedTables
+        """
+        self.tables = self.export_tables(dtype, compact=release)
+        if release:
+            self.emission_PD = None
+            self.transition_PD = None
+            self.generation += 1
+        return self.tables
+
+    # Compare tagging with the quantized tables against the full model
+    def verify_quantized(self, data=None, tables=None):
+        """
+        Tagging accuracy of the full model and of the quantized tables.
+        The model is left decoding as it was.
+        :param data: Tagged sentences to check against, default the test data
+        :type data: list(list(tuple(str,str)))
+        :param tables: The tables to check, default self.tables or else a fresh int16 export
+        :type tables: QuantizedTables
+        :return: Accuracy with the full model, accuracy with the tables, and
+          the number of words tagged differently
+        :rtype: tuple(float,float,int)
+        """
+        if self.emission_PD is None or self.transition_PD is None:
+            raise ValueError('verify_quantized needs the full model, retrain it first')
+        if data is None:
+            data = self.test_data
+        if tables is None:
+            tables = self.tables if self.tables is not None else self.export_tables()
+        saved = self.tables
+        correct = [0, 0]
+        changed = 0
+        total = 0
+        try:
+            for sentence in data:
+                s = [word.lower() for (word, tag) in sentence]
+                self.tables = None
+                self.initialise(s[0])
+                full_tags = self.tag(s[1:])
+                self.tables = tables
+                self.initialise(s[0])
+                quantized_tags = self.tag(s[1:])
+                for ((word, gold), full, quantized) in zip(sentence, full_tags, quantized_tags):
+                    correct[0] += full == gold
+                    correct[1] += quantized == gold
+                    changed += full != quantized
+                    total += 1
+        finally:
+            self.tables = saved
+        if changed:
+            print('Quantized (%s) tables change %s tags, accuracy %.4f -> %.4f'
+                  % (tables.dtype, changed, correct[0]/total, correct[1]/total), file=sys.stderr)
+        return correct[0]/total, correct[1]/total, changed
 
     # Part B: Implementing the Viterbi algorithm.
 
@@ -175,7 +945,11 @@ class HMM:
         # logprob of sentence starting with a state + logprob of the first word | state
         # logprob of sent starting with the state | word
         # => addition of costs: log P(tag | <s>) + log P(word | tag)
-        self.viterbi.append([-(self.transition_PD['<s>'].logprob(state) + self.emission_PD[state].logprob(observation)) for state in self.states])
+        if self.tables is not None:
+            # Same costs from the quantized tables, widened so sums can't overflow
+            self.viterbi.append(self.tables.start.astype(self.tables.accumulator) + self.tables.emission(observation))
+        else:
+            self.viterbi.append([-(self.transition_PD['<s>'].logprob(state) + self.emission_PD[state].logprob(observation)) for state in self.states])
         self.backpointer.append([-1 for i in self.states])
 
     # Tag a new sentence using the trained model and already initialised data structures.
@@ -190,12 +964,15 @@ class HMM:
         :return: List of tags corresponding to each word of the input
         """
         # raise NotImplementedError('HMM.tag')
+        if self.tables is not None:
+            return self.tag_quantized(observations)
 
         # reference: https://web.stanford.edu/~jurafsky/slp3/A.pdf
         
         tags = []
         cMin = [float('inf')]
-        step = 0
+        # Usually 0, later if resuming from cached prefix columns
+        step = len(self.viterbi) - 1
         i = 0
         for t in [word.lower() for word in observations]: 
             # Viterbi and backpointer columns
@@ -232,6 +1009,53 @@ class HMM:
 
         return tags
 
+    # Tag a whole sentence, through self.cache when one is set
+    def tag_sentence(self, sentence):
+        """
+        Tag a whole sentence, initialising the data structures first.
+        Afterwards self.viterbi and self.backpointer hold the sentence's lattice,
+        except that they are left empty when the cache returns a sentence
+        whose lattice columns it has since evicted.
+        :param sentence: List of words (a sentence) to be tagged
+        :type sentence: list(str)
+        :return: List of tags corresponding to each word of the input
+        """
+        words = tuple(word.lower() for word in sentence)
+        if len(words) == 0:
+            return []
+        if self.cache is not None:
+            return self.cache.tag(self, words)
+        self.initialise(words[0])
+        return self.tag(words[1:])
+
+    # Tag a new sentence using the quantized tables in self.tables,
+    #  one transition matrix operation per word instead of a loop over state pairs.
+    def tag_quantized(self, observations):
+        """
+        Tag a new sentence using self.tables and already initialised data structures.
+        :param observations: List of words (a sentence) to be tagged
+        :type observations: list(str)
+        :return: List of tags corresponding to each word of the input
+        """
+        tables = self.tables
+        columns = np.arange(len(self.states))
+        for t in [word.lower() for word in observations]:
+            # Cost of every (last state, current state) pair, best last state per column
+            costs = self.viterbi[-1][:, None] + tables.trans
+            backpointer = costs.argmin(axis=0)
+            self.viterbi.append(costs[backpointer, columns] + tables.emission(t))
+            self.backpointer.append(backpointer)
+
+        # Cost of transition to </s>, then follow the backpointers
+        best = int((self.viterbi[-1] + tables.end).argmin())
+        tags = [self.states[best]]
+        for backpointer in reversed(self.backpointer[1:]):
+            best = backpointer[best]
+            tags.append(self.states[best])
+        tags.reverse()
+
+        return tags
+
 
     def get_viterbi_value(self, state, step):
         """
@@ -246,6 +1070,8 @@ class HMM:
         :rtype: float
         """
         # raise NotImplementedError('HMM.get_viterbi_value')
+        if self.tables is not None:
+            return self.tables.dequantize(self.viterbi[step][self.states.index(state)])
         return self.viterbi[step][self.states.index(state)]
 
 
@@ -270,6 +1096,58 @@ class HMM:
         else:
             return self.states[self.backpointer[step][self.states.index(state)]]
 
+# Sanity checks for Baum-Welch, on models small enough to enumerate
+def check_baum_welch():
+    """
+    Compare the E-step against enumerating every tag sequence, and check
+    the log likelihood never falls across EM iterations.
+    Problems are reported on stderr, like the checks in answers().
+    """
+    rng = np.random.RandomState(0)
+    n_states, n_words = 2, 3
+    # Random log base 2 tables; forward-backward doesn't need them normalised
+    tables = (np.log2(rng.rand(n_states)), np.log2(rng.rand(n_states, n_states)),
+              np.log2(rng.rand(n_states)), np.log2(rng.rand(n_words, n_states)))
+    start, trans, end, emit = tables
+    batches = [np.array([[0]]), np.array([[1, 2], [2, 2]]), np.array([[2, 0, 1]])]
+
+    expected = _ExpectedCounts(n_states, n_words)
+    for ids in batches:
+        for sentence in ids:
+            weights = {}
+            for path in itertools.product(range(n_states), repeat=len(sentence)):
+                weights[path] = start[path[0]] + end[path[-1]] + \
+                    sum(trans[a, b] for (a, b) in zip(path, path[1:])) + \
+                    sum(emit[o, p] for (o, p) in zip(sentence, path))
+            loglik = np.log2(sum(np.exp2(w) for w in weights.values()))
+            expected.loglik += loglik
+            for (path, w) in weights.items():
+                posterior = np.exp2(w - loglik)
+                expected.start[path[0]] += posterior
+                expected.end[path[-1]] += posterior
+                for (a, b) in zip(path, path[1:]):
+                    expected.trans[a, b] += posterior
+                for (o, p) in zip(sentence, path):
+                    expected.emit[o, p] += posterior
+    computed = _ExpectedCounts(n_states, n_words)
+    computed.merge(_baum_welch_expect(batches, tables))
+    for name in ('start', 'trans', 'end', 'emit', 'loglik'):
+        if not np.allclose(getattr(computed, name), getattr(expected, name)):
+            print('Baum-Welch expected %s (%s) should be %s'
+                  % (name, getattr(computed, name), getattr(expected, name)), file=sys.stderr)
+
+    tagged = [[('the', 'DET'), ('cat', 'NOUN'), ('sat', 'VERB')],
+              [('a', 'DET'), ('dog', 'NOUN'), ('ran', 'VERB')],
+              [('dogs', 'NOUN'), ('sat', 'VERB')]]
+    untagged = [['the', 'dog', 'sat'], ['a', 'cat', 'ran'], ['cats', 'ran'],
+                ['the', 'dogs', 'sat'], ['a', 'cat'], ['dog', 'sat']] * 5
+    hmm = HMM(tagged, [])
+    hmm.train()
+    history = hmm.baum_welch(untagged, max_iterations=8, tolerance=0, processes=1)
+    for (before, after) in zip(history, history[1:]):
+        if after < before - 1e-9 * abs(before):
+            print('Baum-Welch log likelihood fell from %s to %s' % (before, after), file=sys.stderr)
+
 def answer_question4b():
     """
     Report a hand-chosen tagged sequence that is incorrect, correct it
@@ -356,6 +1234,8 @@ def answers():
             type(model.states[0])==str):
         print('model.states value (%s) must be a non-empty list of strings'%model.states,file=sys.stderr)
 
+    check_baum_welch()
+
     print('states: %s\n'%model.states)
 
     ######